@@ -1,47 +1,175 @@
-import base64
+import binascii
+import hashlib
 import io
+import multiprocessing
+import os
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import dash
 from dash import dcc, html, Input, Output, State
 import dash_bootstrap_components as dbc
-from pdf2image import convert_from_path, convert_from_bytes
-from PIL import Image
-import pytesseract
-import pdftotext
+from flask_caching import Cache
+from flask_compress import Compress
 from dash.exceptions import PreventUpdate
-import PyInstaller
+import ocr_worker
 
-pytesseract.pytesseract.tesseract_cmd = r'C:\Users\...\AppData\Local\Tesseract-OCR\tesseract.exe' # path to tesseract.exe
+# poppler bin folder and tesseract tessdata folder - from the environment, or next to the executables found on PATH.
+# None falls back to the pdf2image / tesserocr defaults
+_pdftoppm_cmd = shutil.which('pdftoppm')
+poppler_path = os.environ.get('POPPLER_PATH') or (os.path.dirname(_pdftoppm_cmd) if _pdftoppm_cmd else None)
+_tesseract_cmd = shutil.which('tesseract')
+_tesseract_tessdata = os.path.join(os.path.dirname(_tesseract_cmd), 'tessdata') if _tesseract_cmd else None
+tessdata_path = os.environ.get('TESSDATA_PREFIX') or (
+    _tesseract_tessdata if _tesseract_tessdata and os.path.isdir(_tesseract_tessdata) else None)
 
+# single threaded tesseract, parallelism is per page in the OCR workers.
+# must be set before the OCR pool starts, the workers inherit it and load tesseract with it
+os.environ.setdefault('OMP_THREAD_LIMIT', '1')
 
-def pdf_to_images(pdf_b):
+pdf_images_dpi = 150  # enough for the reports fonts and much cheaper to OCR than the 200 dpi default
+
+_ocr_executor = None
+_ocr_executor_lock = threading.Lock()
+
+
+def pdf_to_images(pdf_b, first_page=None, last_page=None):
     """
 
     :param pdf_b: Bytes - pdf file in bytes
+    :param first_page: Integer - first page to convert (1-based), None for the start of the document
+    :param last_page: Integer - last page to convert (1-based), None for the end of the document
     :return: List[Image] - pdf in images
     """
-    local_poppler_path = r'C:\...\Release-23.11.0-0\poppler-23.11.0\Library\bin' # path to local poppler
-    return convert_from_bytes(pdf_b, poppler_path=local_poppler_path)
+    from pdf2image import convert_from_bytes
+    return convert_from_bytes(pdf_b, dpi=pdf_images_dpi, grayscale=True, first_page=first_page, last_page=last_page,
+                              thread_count=os.cpu_count() or 1, poppler_path=poppler_path)
+
+
+def _get_ocr_executor():
+    """
+    get the shared OCR process pool, created on first use and kept alive between uploads
+    so the workers and their loaded language models are reused.
+    the workers are spawned, not forked - the pool is created from a (multi-threaded) server request thread
+    :return: ProcessPoolExecutor - OCR workers pool
+    """
+    global _ocr_executor
+    with _ocr_executor_lock:
+        if _ocr_executor is None:
+            _ocr_executor = ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=ocr_worker.init_worker,
+                                                initargs=(tessdata_path, pdf_images_dpi),
+                                                mp_context=multiprocessing.get_context('spawn'))
+        return _ocr_executor
+
+
+def _drop_ocr_executor(executor):
+    """
+    drop a broken OCR process pool, the next upload creates a new one
+    :param executor: ProcessPoolExecutor - the broken pool
+    """
+    global _ocr_executor
+    with _ocr_executor_lock:
+        if _ocr_executor is executor:
+            _ocr_executor = None
+    executor.shutdown(wait=False)
 
 
 def extract_text_from_images(images):
     """
-    extract text from images using pytesseract
+    extract text from images using tesserocr, pages are processed in parallel worker processes
     :param images: List[Image] - pdf in images
-    :return: String - text from images
+    :return: List[String] - text per image
     """
-    text_per_page = [pytesseract.image_to_string(image, lang='heb+eng') for image in images]
-    return "\n".join(text_per_page)
+    # raw pixel buffers are sent to the workers, avoiding an image encode/decode per page
+    images = [image if image.mode == 'L' else image.convert('L') for image in images]
+    executor = _get_ocr_executor()
+    try:
+        return list(executor.map(ocr_worker.ocr_image, [image.tobytes() for image in images],
+                                 [image.width for image in images], [image.height for image in images]))
+    except BrokenProcessPool:
+        # a worker failed to start or died (e.g. killed while out of memory), don't keep the broken pool
+        _drop_ocr_executor(executor)
+        raise
 
 
 def extract_text_from_pdf(file_content):
     """
-    extracting text from pdf, using pdftotext package
+    extracting text from pdf, using pdftotext package.
+    poppler pdftotext keeps the bidi markers of the hebrew text, the pathology report prefixes rely on them
     :param file_content: Bytes - pdf content in bytes
+    :return: List[String] - text per pdf page
+    """
+    import pdftotext
+    # BytesIO shares the bytes buffer until written to, and needs no closing
+    return list(pdftotext.PDF(io.BytesIO(file_content)))
+
+
+def has_text_layer(pdf_b):
+    """
+    fast scan of the raw pdf bytes for a possible text layer - showing text requires a font resource.
+    font dictionaries may also be packed in compressed object streams, so only a pdf with neither surely has no text
+    :param pdf_b: Bytes - pdf file in bytes
+    :return: Boolean - False if the pdf has no text layer
+    """
+    return b'/Font' in pdf_b or b'/ObjStm' in pdf_b
+
+
+def extract_text(pdf_b):
+    """
+    extract text from pdf, results are cached by the pdf content hash so the same file is extracted only once
+    :param pdf_b: Bytes - pdf file in bytes
+    :return: String - text from pdf
+    """
+    pdf_hash = hashlib.blake2b(pdf_b).hexdigest()
+    text = cache.get(pdf_hash)
+    if text is None:
+        text = _extract_text(pdf_b)
+        cache.set(pdf_hash, text)
+    return text
+
+
+def _extract_text(pdf_b):
+    """
+    extract text from pdf, pages without a usable text layer are converted to images and OCR'ed
+    :param pdf_b: Bytes - pdf file in bytes
     :return: String - text from pdf
     """
-    with io.BytesIO(file_content) as f:
-        pdf = pdftotext.PDF(f)
-        return "\n\n".join(pdf)
+    if not has_text_layer(pdf_b):
+        return "\n\n".join(extract_text_from_images(pdf_to_images(pdf_b)))
+
+    text_per_page = extract_text_from_pdf(pdf_b)
+    ocr_pages = [i for i, page_text in enumerate(text_per_page) if len(page_text.strip()) < 20]
+    if not ocr_pages:
+        return "\n\n".join(text_per_page)
+
+    # consecutive pages are converted together, one poppler call per run of pages
+    page_runs = []
+    for i in ocr_pages:
+        if page_runs and page_runs[-1][1] == i - 1:
+            page_runs[-1][1] = i
+        else:
+            page_runs.append([i, i])
+    images = []
+    for first, last in page_runs:
+        images.extend(pdf_to_images(pdf_b, first_page=first + 1, last_page=last + 1))
+
+    for i, page_text in zip(ocr_pages, extract_text_from_images(images)):
+        text_per_page[i] = page_text
+    return "\n\n".join(text_per_page)
+
+
+# pathology report body sections prefixes, in the order the sections appear in the report
+body_parts_prefixes = {
+    "Clinical Information": "‫פרטים קליניים‪:",
+    "Previous Tests": "‫בדיקות קודמות‪:",
+    "Diagnosis": "אבחנה‪:‬‬",
+    "Macroscopic Description": "תאור מאקרוסקופי‪:‬‬",
+}
+# prefixes that may open the report body, by priority
+body_start_prefixes = ["‫פרטים קליניים‪:", "בדיקות קודמות‪:‬‬", "‫אבחנה‪:‬‬"]
+footer_prefix = "תאריך הדפסה‪:‬‬"
 
 
 def get_pathology_body_parts(body):
@@ -50,41 +178,18 @@ def get_pathology_body_parts(body):
     :param body: String - full text
     :return: Dictionary - dictionary of pathology report parts
     """
-    body_parts_dict = {}
-    # macro_desc
-    macro_prefix_index = body.find("תאור מאקרוסקופי‪:‬‬")
-    if macro_prefix_index != -1:
-        body_parts_dict["Macroscopic Description"] = body[macro_prefix_index:]
-        body = body[:macro_prefix_index]
-
-    # diagnosis
-    diagnosis_prefix_index = body.find("אבחנה‪:‬‬")
-    if diagnosis_prefix_index != -1:
-        body_parts_dict["Diagnosis"] = body[diagnosis_prefix_index:]
-        body = body[:diagnosis_prefix_index]
-
-    # prev_tests
-    prev_tests_prefix_index = body.find("‫בדיקות קודמות‪:")
-    if prev_tests_prefix_index != -1:
-        body_parts_dict["Previous Tests"] = body[prev_tests_prefix_index:]
-        body = body[:prev_tests_prefix_index]
-
-    # clinical_info
-    clinical_info_prefix_index = body.find("‫פרטים קליניים‪:")
-    if clinical_info_prefix_index != -1:
-        body_parts_dict["Clinical Information"] = body[clinical_info_prefix_index:]
-        body = body[:clinical_info_prefix_index]
-
-    ans_body_parts_dict = {}
-    if clinical_info_prefix_index != -1:
-        ans_body_parts_dict["Clinical Information"] = body_parts_dict.get("Clinical Information")
-    if prev_tests_prefix_index != -1:
-        ans_body_parts_dict["Previous Tests"] = body_parts_dict.get("Previous Tests")
-    if diagnosis_prefix_index != -1:
-        ans_body_parts_dict["Diagnosis"] = body_parts_dict.get("Diagnosis")
-    if macro_prefix_index != -1:
-        ans_body_parts_dict["Macroscopic Description"] = body_parts_dict.get("Macroscopic Description")
-    return ans_body_parts_dict
+    # sections are searched from the last one backwards, each one only before the next found section.
+    # the body is then sliced once per section
+    section_starts = []
+    end = len(body)
+    for title in reversed(body_parts_prefixes):
+        start = body.find(body_parts_prefixes[title], 0, end)
+        if start != -1:
+            section_starts.append((start, title))
+            end = start
+    section_starts.reverse()
+    section_ends = [start for start, _ in section_starts[1:]] + [len(body)]
+    return {title: body[start:end] for (start, title), end in zip(section_starts, section_ends)}
 
 
 def get_partial_content(original_content):
@@ -94,14 +199,13 @@ def get_partial_content(original_content):
     :return: Dictionary - dictionary of pathology report parts
     """
     header, body, footer = """""", """""", """"""
-    prefix_options = ["‫פרטים קליניים‪:", "בדיקות קודמות‪:‬‬", "‫אבחנה‪:‬‬"]
-    for p in prefix_options:
+    for p in body_start_prefixes:
         prefix_index = original_content.find(p)
         if prefix_index != -1:
             header = original_content[:prefix_index]
             body = original_content[prefix_index:]
             break
-    postfix_index = body.find("תאריך הדפסה‪:‬‬")
+    postfix_index = body.find(footer_prefix)
     footer = body[postfix_index:]
     body = body[:postfix_index]
     body_parts = get_pathology_body_parts(body)
@@ -119,24 +223,26 @@ def extract_children_values(data):
     :return: String - extracted string
     """
     result = []
-
-    def recurse(item):
-        if isinstance(item, dict):
-            for key, value in item.items():
-                if key == 'children' and isinstance(value, str):
-                    result.append(value)
-                elif isinstance(value, (dict, list)):
-                    recurse(value)
+    # iterative walk, items are pushed in reverse so they are popped in the original order
+    stack = deque([data] if isinstance(data, (dict, list)) else [])
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            result.append(item)
+        elif isinstance(item, dict):
+            stack.extend(value for key, value in reversed(item.items())
+                         if (key == 'children' and isinstance(value, str)) or isinstance(value, (dict, list)))
         elif isinstance(item, list):
-            for sub_item in item:
-                recurse(sub_item)
-
-    recurse(data)
+            stack.extend(sub_item for sub_item in reversed(item) if isinstance(sub_item, (dict, list)))
     return "\n".join(result)
 
 
 # Dash Layout
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.CYBORG])
+# gzip the callbacks responses, the extracted text and report cards compress well
+Compress(app.server)
+# in-memory cache of extracted texts, the reports are not written to disk
+cache = Cache(app.server, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 3600, 'CACHE_THRESHOLD': 100})
 
 colors = {
     'background': '#15112b',
@@ -147,7 +253,22 @@ colors = {
     'quaternary': '#e6e6e6'
 }
 
+card_header_style = {'color': colors['secondary'], 'backgroundColor': '#464545', 'font-weight': 'bold'}
+card_body_style = {'backgroundColor': colors['quaternary'], 'color': '#000000'}
+tab2_output_style = {
+    'border': '1px solid #ddd',
+    'padding': '10px',
+    'minHeight': '200px',
+    'maxHeight': '600px',  # Maximum height for scrolling
+    'marginTop': '10px',
+    'whiteSpace': 'pre-wrap',
+    'backgroundColor': colors['quaternary'],
+    'color': colors['background'],
+    'overflowY': 'scroll'  # Add vertical scrollbar
+}
+
 app.layout = dbc.Container([
+    dcc.Store(id='extracted-text', storage_type='memory'),
     dbc.Row(
         dbc.Col(html.Img(src='/assets/logo.png', className="img-fluid mx-auto d-block mb-4",
                          style={'border-radius': '10%'}), width=12, className="text-center")
@@ -223,7 +344,8 @@ app.layout = dbc.Container([
                         }),
 
                         dbc.Button("Save Output", id='save-button-tab2', color='primary', className="mt-4"),
-                        dcc.Download(id="download-text-tab2")
+                        dcc.Download(id="download-text-tab2"),
+                        html.Div(id='output-text-tab2-content', style={'display': 'none'})  # shown with the output
                     ])
 
             ]),
@@ -236,23 +358,21 @@ app.layout = dbc.Container([
 
 
 # Callback Functions
-@app.callback(
-    Output('output-text-tab1', 'children'),
-    Input('upload-file-tab1', 'contents'),
-    State('upload-file-tab1', 'filename')
-)
-def update_output_tab1(file_content, file_name):
+def extract_uploaded_text(file_content, file_name):
+    """
+    decode an uploaded file and extract its text, both tabs display it from the shared store
+    :param file_content: String - uploaded file as base64 data url
+    :param file_name: String - uploaded file name
+    :return: String - text from the uploaded pdf
+    """
     if file_content is None:
         raise PreventUpdate
 
-    content_type, content_string = file_content.split(',')
-    decoded = base64.b64decode(content_string)
+    # strip the data url prefix ("data:<type>;base64,")
+    decoded = binascii.a2b_base64(file_content[file_content.index(',') + 1:])
 
     if file_name.lower().endswith('.pdf'):
-        text = extract_text_from_pdf(decoded)
-        if not text.strip() or len(text) < 20:
-            images = pdf_to_images(decoded)
-            text = extract_text_from_images(images)
+        text = extract_text(decoded)
     else:
         raise PreventUpdate
 
@@ -260,61 +380,55 @@ def update_output_tab1(file_content, file_name):
 
 
 @app.callback(
-    Output('tab-2', 'children'),
+    Output('extracted-text', 'data', allow_duplicate=True),
+    Input('upload-file-tab1', 'contents'),
+    State('upload-file-tab1', 'filename'),
+    prevent_initial_call=True,
+)
+def extract_uploaded_text_tab1(file_content, file_name):
+    return extract_uploaded_text(file_content, file_name)
+
+
+@app.callback(
+    Output('extracted-text', 'data', allow_duplicate=True),
     Input('upload-file-tab2', 'contents'),
     State('upload-file-tab2', 'filename'),
-    State('tab-2', 'children')
+    prevent_initial_call=True,
 )
-def update_output_tab2(file_content, file_name, tab2_children):
-    if file_content is None:
-        raise PreventUpdate
+def extract_uploaded_text_tab2(file_content, file_name):
+    return extract_uploaded_text(file_content, file_name)
 
-    content_type, content_string = file_content.split(',')
-    decoded = base64.b64decode(content_string)
 
-    if file_name.lower().endswith('.pdf'):
-        text = extract_text_from_pdf(decoded)
-        if not text.strip() or len(text) < 20:
-            images = pdf_to_images(decoded)
-            text = extract_text_from_images(images)
-    else:
+# tab 1 shows the stored text as is, done in the browser to avoid sending the text back and forth
+app.clientside_callback(
+    """
+    function(text) {
+        if (text === null || text === undefined) {
+            return window.dash_clientside.no_update;
+        }
+        return text;
+    }
+    """,
+    Output('output-text-tab1', 'children'),
+    Input('extracted-text', 'data')
+)
+
+
+@app.callback(
+    Output('output-text-tab2-content', 'children'),
+    Output('output-text-tab2-content', 'style'),
+    Input('extracted-text', 'data')
+)
+def update_output_tab2(text):
+    if text is None:
         raise PreventUpdate
 
     text = f"'\u202B'{text}'\u202C'"
     ans_parts = get_partial_content(text)
-    new_cards = []
-    for title, content in ans_parts.items():
-        new_card = dbc.Card(
-            [
-                dbc.CardHeader(f"{title}", style={'color': colors['secondary'], 'backgroundColor': '#464545',
-                                                  'font-weight': 'bold'}),
-                dbc.CardBody(f"{content}", style={'backgroundColor': colors['quaternary'], 'color': '#000000'})
-            ]
-            # className="mb-3"
-        )
-        new_cards.append(new_card)
-    new_div = html.Div(children=new_cards,
-                       id=f'output-text-tab2-content', style={
-            'border': '1px solid #ddd',
-            'padding': '10px',
-            'minHeight': '200px',
-            'maxHeight': '600px',  # Maximum height for scrolling
-            'marginTop': '10px',
-            'whiteSpace': 'pre-wrap',
-            'backgroundColor': colors['quaternary'],
-            'color': colors['background'],
-            'overflowY': 'scroll'  # Add vertical scrollbar
-        })
-
-    if tab2_children:
-        for child in tab2_children:
-            if child['type'] == 'Div':
-                tab2_children.remove(child)
-                break
-        tab2_children.append(new_div)
-        return tab2_children
-
-    return new_div
+    new_cards = [dbc.Card([dbc.CardHeader(title, style=card_header_style),
+                           dbc.CardBody(content, style=card_body_style)])
+                 for title, content in ans_parts.items()]
+    return new_cards, tab2_output_style
 
 
 @app.callback(
@@ -327,8 +441,9 @@ def save_text_tab1(n_clicks, text):
     if not text:
         raise PreventUpdate
     # Convert HTML breaks back to newlines
-    plain_text = text.replace('<br>', '\n')
-    return dict(content=plain_text, filename="extracted_text_tab1.txt")
+    if '<br>' in text:
+        text = text.replace('<br>', '\n')
+    return dcc.send_string(text, "extracted_text_tab1.txt")
 
 
 @app.callback(
@@ -342,8 +457,9 @@ def save_text_tab2(n_clicks, text):
         raise PreventUpdate
     text = extract_children_values(text)
     # Convert HTML breaks back to newlines
-    plain_text1 = text.replace('<br>', '\n')
-    return dict(content=plain_text1, filename="extracted_text_tab2.txt")
+    if '<br>' in text:
+        text = text.replace('<br>', '\n')
+    return dcc.send_string(text, "extracted_text_tab2.txt")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,29 @@
+_api = None  # tesseract API handle of the current OCR worker
+_dpi = None  # resolution of the OCR'ed page images
+
+
+def init_worker(tessdata_path, dpi):
+    """
+    OCR worker initializer - tesserocr is imported only in the workers,
+    the heb+eng language model is loaded once per worker and reused for all of its pages
+    :param tessdata_path: String - tesseract tessdata folder, None for the tesserocr default
+    :param dpi: Integer - resolution of the page images
+    """
+    global _api, _dpi
+    from tesserocr import PyTessBaseAPI, OEM
+    api_kwargs = {'path': tessdata_path} if tessdata_path else {}
+    _api = PyTessBaseAPI(lang='heb+eng', oem=OEM.LSTM_ONLY, **api_kwargs)
+    _dpi = dpi
+
+
+def ocr_image(image_bytes, width, height):
+    """
+    extract text from a single image using the worker tesseract API
+    :param image_bytes: Bytes - raw 8 bit grayscale pixels of a pdf page
+    :param width: Integer - image width in pixels
+    :param height: Integer - image height in pixels
+    :return: String - text from image
+    """
+    _api.SetImageBytes(image_bytes, width, height, 1, width)
+    _api.SetSourceResolution(_dpi)
+    return _api.GetUTF8Text()